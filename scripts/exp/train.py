@@ -1,8 +1,9 @@
 import os
 import sys
+import contextlib
 import warnings
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional, Tuple
 from dataclasses import dataclass
 
 import argbind
@@ -11,14 +12,15 @@ import torch
 import torch.nn as nn
 from audiotools import AudioSignal
 from audiotools.data import transforms
-from einops import rearrange
 from rich import pretty
 from rich.traceback import install
+from torch.distributed.optim import ZeroRedundancyOptimizer
 from torch.utils.tensorboard import SummaryWriter
 
 import vampnet
 from vampnet.modules.transformer import VampNet
-from vampnet.util import codebook_unflatten, codebook_flatten
+from vampnet.util import codebook_unflatten, codebook_flatten, parallelize
+from vampnet.util import cudagraph_mark_step_begin
 from vampnet import mask as pmask
 # from dac.model.dac import DAC
 from lac.model.lac import LAC as DAC
@@ -31,11 +33,17 @@ import loralib as lora
 
 import torch._dynamo
 torch._dynamo.config.verbose=True
+# train / eval modes and the val + sampling batch sizes each get their own graph
+torch._dynamo.config.cache_size_limit = 64
 
 
 # Enable cudnn autotuner to speed up training
 # (can be altered by the funcs.seed function)
 torch.backends.cudnn.benchmark = bool(int(os.getenv("CUDNN_BENCHMARK", 1)))
+# Allow tf32 for any matmuls / convs left in fp32 (e.g. inside the codec)
+torch.set_float32_matmul_precision("high")
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 # Uncomment to trade memory for speed.
 
 # Install to make things look nice
@@ -68,6 +76,28 @@ AudioDataset = argbind.bind(at.datasets.AudioDataset, "train", "val")
 IGNORE_INDEX = -100
 
 
+def unwrap(model):
+    # strip the torch.compile and DDP wrappers to get to the VampNet
+    model = getattr(model, "_orig_mod", model)
+    return model.module if hasattr(model, "module") else model
+
+
+def amp_dtype():
+    # bf16 has the same dynamic range as fp32, so it doesn't need loss scaling.
+    # use it whenever the hardware supports it (ampere+), fall back to fp16 otherwise
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
+
+
+def autocast(accel: Accelerator):
+    return torch.autocast(accel.device, dtype=amp_dtype(), enabled=accel.amp)
+
+
+def uses_grad_scaler(accel: Accelerator):
+    return accel.amp and amp_dtype() == torch.float16
+
+
 @argbind.bind("train", "val", without_prefix=True)
 def build_transform():
     transform = transforms.Compose(
@@ -78,6 +108,104 @@ def build_transform():
     return transform
 
 
+def prepare_batch(batch, device: str):
+    """
+    like `at.util.prepare_batch`, but w/ non blocking copies, so that
+    copies out of pinned memory can overlap w/ compute.
+    """
+    if isinstance(batch, dict):
+        return {k: prepare_batch(v, device) for k, v in batch.items()}
+    if torch.is_tensor(batch):
+        return batch.to(device, non_blocking=True)
+    if isinstance(batch, AudioSignal):
+        batch.audio_data = batch.audio_data.to(device, non_blocking=True)
+        return batch.to(device)
+    return batch
+
+
+class PinnedSignal:
+    """
+    the dataloader's pin memory thread only pins tensors (and objects w/ a
+    `pin_memory` method), so it leaves the AudioSignals in a batch in pageable
+    memory. wrapping them in this gets their samples pinned too (and unwraps
+    them), so that the h2d copies of the audio can actually be async.
+    """
+
+    def __init__(self, signal: AudioSignal):
+        self.signal = signal
+
+    def pin_memory(self, *args):
+        self.signal.audio_data = self.signal.audio_data.pin_memory()
+        return self.signal
+
+
+class PinSignalsCollate:
+    """
+    wraps a collate fn, so that every AudioSignal in the collated batch gets
+    pinned by the dataloader (see PinnedSignal). only use w/ pin_memory=True,
+    otherwise the signals never get unwrapped.
+    """
+
+    def __init__(self, collate):
+        self.collate = collate
+
+    def __call__(self, items):
+        return self._wrap(self.collate(items))
+
+    def _wrap(self, batch):
+        if isinstance(batch, dict):
+            return {k: self._wrap(v) for k, v in batch.items()}
+        if isinstance(batch, AudioSignal):
+            return PinnedSignal(batch)
+        return batch
+
+
+class CUDAPrefetcher:
+    """
+    wraps a dataloader, and copies the next batch to the device on a side
+    stream while the current one is in use, so that the h2d copies overlap
+    w/ the compute of the current step.
+    """
+
+    def __init__(self, loader, device: str):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream() if device == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, it):
+        batch = next(it, None)
+        if batch is None or self.stream is None:
+            return batch
+        with torch.cuda.stream(self.stream):
+            return prepare_batch(batch, self.device)
+
+    def _record_stream(self, batch, stream):
+        # the batch was allocated on our side stream, let the caching
+        # allocator know it's being used on the compute stream
+        if isinstance(batch, dict):
+            for v in batch.values():
+                self._record_stream(v, stream)
+        elif torch.is_tensor(batch):
+            batch.record_stream(stream)
+        elif isinstance(batch, AudioSignal):
+            batch.audio_data.record_stream(stream)
+
+    def __iter__(self):
+        it = iter(self.loader)
+        batch = self._preload(it)
+        while batch is not None:
+            if self.stream is not None:
+                stream = torch.cuda.current_stream()
+                stream.wait_stream(self.stream)
+                self._record_stream(batch, stream)
+            next_batch = self._preload(it)
+            yield batch
+            batch = next_batch
+
+
 @torch.no_grad()
 def apply_transform(transform_fn, batch):
     sig: AudioSignal = batch["signal"]
@@ -97,6 +225,36 @@ def build_datasets(args, sample_rate: int):
     return train_data, val_data
 
 
+class SobolPool:
+    """
+    draws sobol samples in large chunks and keeps them on device, so that
+    getting a new batch of samples doesn't block on a cpu draw + h2d copy
+    every step. drop-in for `SobolEngine.draw`.
+    """
+
+    def __init__(
+        self,
+        rng: torch.quasirandom.SobolEngine,
+        device: str,
+        size: int = 2**16,
+    ):
+        self.rng = rng
+        self.device = device
+        self.size = size
+        self._refill(size)
+
+    def _refill(self, n: int):
+        self.pool = self.rng.draw(max(n, self.size)).to(self.device)
+        self.cursor = 0
+
+    def draw(self, n: int):
+        if self.cursor + n > self.pool.shape[0]:
+            self._refill(n)
+        samples = self.pool[self.cursor : self.cursor + n]
+        self.cursor += n
+        return samples
+
+
 def rand_float(shape, low, high, rng):
     return rng.draw(shape)[:, 0] * (high - low) + low
 
@@ -110,12 +268,15 @@ def num_params_hook(o, p):
 
 
 def add_num_params_repr_hook(model):
-    import numpy as np
     from functools import partial
 
-    for n, m in model.named_modules():
+    # walk the modules bottom up, so each module can reuse its children's counts
+    n_params = {}
+    for n, m in reversed(list(model.named_modules())):
         o = m.extra_repr()
-        p = sum([np.prod(p.size()) for p in m.parameters()])
+        p = sum(t.numel() for t in m.parameters(recurse=False))
+        p += sum(n_params[c] for c in m.children())
+        n_params[m] = p
 
         setattr(m, "extra_repr", partial(num_params_hook, o=o, p=p))
 
@@ -123,62 +284,74 @@ def add_num_params_repr_hook(model):
 def accuracy(
     preds: torch.Tensor,
     target: torch.Tensor,
-    top_k: int = 1,
-    ignore_index: Optional[int] = None,
-) -> torch.Tensor:
-    # Flatten the predictions and targets to be of shape (batch_size * sequence_length, n_class)
-    preds = rearrange(preds, "b p s -> (b s) p")
-    target = rearrange(target, "b s -> (b s)")
+    valid_masks: Dict[str, torch.Tensor],
+    top_k: Tuple[int, ...] = (1,),
+) -> Dict[str, torch.Tensor]:
+    """
+    top-k accuracy of `preds` (batch, classes, seq) against `target` (batch, seq),
+    counted only over the positions in each of the (bool, batch x seq) `valid_masks`.
+    returns {f"top{k}/{name}": accuracy}.
+    """
+    # the top-k for the largest k contains all the smaller ones, so one topk pass does
+    # shape (batch, max(top_k), seq), sorted by score
+    pred_indices = preds.topk(k=max(top_k), dim=1).indices
 
-    # return torchmetrics.functional.accuracy(preds, target, task='multiclass', top_k=topk, num_classes=preds.shape[-1], ignore_index=ignore_index)
-    if ignore_index is not None:
-        # Create a mask for the ignored index
-        mask = target != ignore_index
-        # Apply the mask to the target and predictions
-        preds = preds[mask]
-        target = target[mask]
+    output = {}
+    for k in top_k:
+        # Determine if the true target is in the top-k predicted classes
+        correct = (pred_indices[:, :k] == target.unsqueeze(1)).any(dim=1)
+        for name, valid in valid_masks.items():
+            output[f"top{k}/{name}"] = (correct & valid).sum() / valid.sum().clamp_min(1)
 
-    # Get the top-k predicted classes and their indices
-    _, pred_indices = torch.topk(preds, k=top_k, dim=-1)
+    return output
 
-    # Determine if the true target is in the top-k predicted classes
-    correct = torch.sum(torch.eq(pred_indices, target.unsqueeze(1)), dim=1)
 
-    # Calculate the accuracy
-    accuracy = torch.mean(correct.float())
+def encode(codec, signal: AudioSignal, n_codebooks: int):
+    # the codec always runs in fp32 (even under amp), so these are the exact same
+    # tokens as Interface.encode, and the codebook argmins don't flip in low precision
+    with torch.inference_mode(), torch.autocast(
+        signal.samples.device.type, enabled=False
+    ):
+        z = codec.encode(signal.samples, signal.sample_rate)["codes"]
+    # clone out of inference mode, so that z can be used w/ autograd (and dynamo)
+    return z[:, :n_codebooks, :].clone()
+
+
+@torch.compile(dynamic=False)
+def mask_and_embed(z: torch.Tensor, r: torch.Tensor, vn: VampNet, codec):
+    """
+    sample a random mask for each item in z according to the schedule at r,
+    apply it, and look up the latents for the masked tokens.
+    compiled, so that the many small mask ops get fused together.
+    """
+    mask = pmask.random(z, r)
+    mask = pmask.codebook_unmask(mask, vn.n_conditioning_codebooks)
+    z_mask, mask = pmask.apply_mask(z, mask, vn.mask_token)
+
+    z_mask_latent = vn.embedding.from_codes(z_mask, codec)
+    return z_mask, mask, z_mask_latent
 
-    return accuracy
 
 def _metrics(z_hat, r, target, flat_mask, output):
+    flat_mask = flat_mask.bool()
     for r_range in [(0, 0.5), (0.5, 1.0)]:
-        unmasked_target = target.masked_fill(flat_mask.bool(), IGNORE_INDEX)
-        masked_target = target.masked_fill(~flat_mask.bool(), IGNORE_INDEX)
-
         assert target.shape[0] == r.shape[0]
         # grab the indices of the r values that are in the range
         r_idx = (r >= r_range[0]) & (r < r_range[1])
 
-        # grab the target and z_hat values that are in the range
-        r_unmasked_target = unmasked_target[r_idx]
-        r_masked_target = masked_target[r_idx]
+        # grab the target, mask and z_hat values that are in the range
+        r_target = target[r_idx]
+        r_mask = flat_mask[r_idx]
         r_z_hat = z_hat[r_idx]
 
-        for topk in (1, 25):
-            s, e = r_range
-            tag = f"accuracy-{s}-{e}/top{topk}"
-
-            output[f"{tag}/unmasked"] = accuracy(
-                preds=r_z_hat,
-                target=r_unmasked_target,
-                ignore_index=IGNORE_INDEX,
-                top_k=topk,
-            )
-            output[f"{tag}/masked"] = accuracy(
-                preds=r_z_hat,
-                target=r_masked_target,
-                ignore_index=IGNORE_INDEX,
-                top_k=topk,
-            )
+        s, e = r_range
+        r_accuracy = accuracy(
+            r_z_hat, r_target,
+            valid_masks={"unmasked": ~r_mask, "masked": r_mask},
+            top_k=(1, 25),
+        )
+        for name, value in r_accuracy.items():
+            output[f"accuracy-{s}-{e}/{name}"] = value
 
 
 @dataclass
@@ -190,8 +363,9 @@ class State:
     scheduler: NoamScheduler
     criterion: CrossEntropyLoss
     grad_clip_val: float
+    grad_acc_steps: int
 
-    rng: torch.quasirandom.SobolEngine
+    rng: SobolPool
 
     train_data: AudioDataset
     val_data: AudioDataset
@@ -202,64 +376,69 @@ class State:
 @timer()
 def train_loop(state: State, batch: dict, accel: Accelerator):
     state.model.train()
-    batch = at.util.prepare_batch(batch, accel.device)
+    # a compiled model replays cuda graphs (max-autotune), tell it a new
+    # iteration is starting so it can safely reuse last step's static buffers
+    if hasattr(state.model, "_orig_mod"):
+        cudagraph_mark_step_begin()
+    batch = prepare_batch(batch, accel.device)
     signal = apply_transform(state.train_data.transform, batch)
 
     output = {}
-    vn = accel.unwrap(state.model)
-    with accel.autocast():
-        with torch.inference_mode():
-            state.codec.to(accel.device)
-            z = state.codec.encode(signal.samples, signal.sample_rate)["codes"]
-            z = z[:, : vn.n_codebooks, :]
+    vn = unwrap(state.model)
+    # only sync grads across ranks (and step) at the end of an accumulation window
+    acc_boundary = (state.tracker.step + 1) % state.grad_acc_steps == 0
+    no_sync = (
+        state.model.no_sync
+        if not acc_boundary and hasattr(state.model, "no_sync")
+        else contextlib.nullcontext
+    )
+    with no_sync():
+        with autocast(accel):
+            z = encode(state.codec, signal, vn.n_codebooks)
 
-        n_batch = z.shape[0]
-        r = state.rng.draw(n_batch)[:, 0].to(accel.device)
+            n_batch = z.shape[0]
+            r = state.rng.draw(n_batch)[:, 0]
 
-        mask = pmask.random(z, r)
-        mask = pmask.codebook_unmask(mask, vn.n_conditioning_codebooks)
-        z_mask, mask = pmask.apply_mask(z, mask, vn.mask_token)
-        
-        z_mask_latent = vn.embedding.from_codes(z_mask, state.codec)
+            z_mask, mask, z_mask_latent = mask_and_embed(z, r, vn, state.codec)
 
-        dtype = torch.bfloat16 if accel.amp else None
-        with accel.autocast(dtype=dtype):
             z_hat = state.model(z_mask_latent)
 
-        target = codebook_flatten(
-            z[:, vn.n_conditioning_codebooks :, :],
-        )
+            target = codebook_flatten(
+                z[:, vn.n_conditioning_codebooks :, :],
+            )
 
-        flat_mask = codebook_flatten(
-            mask[:, vn.n_conditioning_codebooks :, :],
-        )
+            flat_mask = codebook_flatten(
+                mask[:, vn.n_conditioning_codebooks :, :],
+            )
 
-        # replace target with ignore index for masked tokens
-        t_masked = target.masked_fill(~flat_mask.bool(), IGNORE_INDEX)
-        output["loss"] = state.criterion(z_hat, t_masked)
+            # replace target with ignore index for masked tokens
+            t_masked = torch.where(flat_mask.bool(), target, IGNORE_INDEX)
+            output["loss"] = state.criterion(z_hat, t_masked)
 
-        _metrics(
-            r=r,
-            z_hat=z_hat,
-            target=target,
-            flat_mask=flat_mask,
-            output=output,
-        )
+            _metrics(
+                r=r,
+                z_hat=z_hat,
+                target=target,
+                flat_mask=flat_mask,
+                output=output,
+            )
 
-    
-    accel.backward(output["loss"])
+        accel.backward(output["loss"] / state.grad_acc_steps)
 
     output["other/learning_rate"] = state.optimizer.param_groups[0]["lr"]
     output["other/batch_size"] = z.shape[0]
 
+    if not acc_boundary:
+        return {k: v for k, v in sorted(output.items())}
 
-    accel.scaler.unscale_(state.optimizer)
+    if uses_grad_scaler(accel):
+        accel.scaler.unscale_(state.optimizer)
     output["other/grad_norm"] = torch.nn.utils.clip_grad_norm_(
         state.model.parameters(), state.grad_clip_val
     )
 
     accel.step(state.optimizer)
-    state.optimizer.zero_grad()
+    state.optimizer.zero_grad(set_to_none=True)
 
     state.scheduler.step()
     accel.update()
@@ -273,44 +452,40 @@ def train_loop(state: State, batch: dict, accel: Accelerator):
 def val_loop(state: State, batch: dict, accel: Accelerator):
     state.model.eval()
     state.codec.eval()
-    batch = at.util.prepare_batch(batch, accel.device)
+    batch = prepare_batch(batch, accel.device)
     signal = apply_transform(state.val_data.transform, batch)
 
-    vn = accel.unwrap(state.model)
-    z = state.codec.encode(signal.samples, signal.sample_rate)["codes"]
-    z = z[:, : vn.n_codebooks, :]
+    vn = unwrap(state.model)
+    output = {}
+    with autocast(accel):
+        z = encode(state.codec, signal, vn.n_codebooks)
 
-    n_batch = z.shape[0]
-    r = state.rng.draw(n_batch)[:, 0].to(accel.device)
+        n_batch = z.shape[0]
+        r = state.rng.draw(n_batch)[:, 0]
 
-    mask = pmask.random(z, r)
-    mask = pmask.codebook_unmask(mask, vn.n_conditioning_codebooks)
-    z_mask, mask = pmask.apply_mask(z, mask, vn.mask_token)
+        z_mask, mask, z_mask_latent = mask_and_embed(z, r, vn, state.codec)
 
-    z_mask_latent = vn.embedding.from_codes(z_mask, state.codec)
+        z_hat = state.model(z_mask_latent)
 
-    z_hat = state.model(z_mask_latent)
+        target = codebook_flatten(
+            z[:, vn.n_conditioning_codebooks :, :],
+        )
 
-    target = codebook_flatten(
-        z[:, vn.n_conditioning_codebooks :, :],
-    )
+        flat_mask = codebook_flatten(
+            mask[:, vn.n_conditioning_codebooks :, :]
+        )
 
-    flat_mask = codebook_flatten(
-        mask[:, vn.n_conditioning_codebooks :, :]
-    )
+        # replace target with ignore index for masked tokens
+        t_masked = torch.where(flat_mask.bool(), target, IGNORE_INDEX)
+        output["loss"] = state.criterion(z_hat, t_masked)
 
-    output = {}
-    # replace target with ignore index for masked tokens
-    t_masked = target.masked_fill(~flat_mask.bool(), IGNORE_INDEX)
-    output["loss"] = state.criterion(z_hat, t_masked)
-
-    _metrics(
-        r=r,
-        z_hat=z_hat,
-        target=target,
-        flat_mask=flat_mask,
-        output=output,
-    )
+        _metrics(
+            r=r,
+            z_hat=z_hat,
+            target=target,
+            flat_mask=flat_mask,
+            output=output,
+        )
 
     return output
 
@@ -346,7 +521,7 @@ def checkpoint(state, save_iters, save_path, fine_tune):
             # save the lora model 
             (Path(save_path) / tag).mkdir(parents=True, exist_ok=True)
             torch.save(
-                lora.lora_state_dict(accel.unwrap(state.model)), 
+                lora.lora_state_dict(unwrap(state.model)), 
                 f"{save_path}/{tag}/lora.pth"
             )
 
@@ -358,22 +533,23 @@ def checkpoint(state, save_iters, save_path, fine_tune):
             "metadata.pth": metadata,
         }
 
-        accel.unwrap(state.model).metadata = metadata
-        accel.unwrap(state.model).save_to_folder(
+        unwrap(state.model).metadata = metadata
+        unwrap(state.model).save_to_folder(
             f"{save_path}/{tag}", model_extra, package=False
         )
 
 
 def save_sampled(state, z, writer):
-    num_samples = z.shape[0]
+    sampled = unwrap(state.model).generate(
+        codec=state.codec,
+        time_steps=z.shape[-1],
+        start_tokens=z,
+        # the val excerpts are always the same shape, so compile the sampling loop
+        compile_forward=True,
+    )
 
-    for i in range(num_samples):
-        sampled = accel.unwrap(state.model).generate(
-            codec=state.codec,
-            time_steps=z.shape[-1],
-            start_tokens=z[i : i + 1],
-        )
-        sampled.cpu().write_audio_to_tb(
+    for i in range(sampled.batch_size):
+        sampled[i].cpu().write_audio_to_tb(
             f"sampled/{i}",
             writer,
             step=state.tracker.step,
@@ -381,30 +557,30 @@ def save_sampled(state, z, writer):
         )
 
 
-def save_imputation(state, z, val_idx, writer):
+def save_imputation(state, z, val_idx, writer, reconstructed: Optional[AudioSignal] = None):
     n_prefix = int(z.shape[-1] * 0.25)
     n_suffix = int(z.shape[-1] *  0.25)
 
-    vn = accel.unwrap(state.model)
+    vn = unwrap(state.model)
 
     mask = pmask.inpaint(z, n_prefix, n_suffix)
     mask = pmask.codebook_unmask(mask, vn.n_conditioning_codebooks)
     z_mask, mask = pmask.apply_mask(z, mask, vn.mask_token)
 
     imputed_noisy = vn.to_signal(z_mask, state.codec)
-    imputed_true = vn.to_signal(z, state.codec)
-
-    imputed = []
-    for i in range(len(z)):
-        imputed.append(
-            vn.generate(
-                codec=state.codec,
-                time_steps=z.shape[-1],
-                start_tokens=z[i][None, ...],
-                mask=mask[i][None, ...],
-            )   
-        )   
-    imputed = AudioSignal.batch(imputed)
+    # reuse the decoded clean signal if the caller already has it
+    imputed_true = (
+        reconstructed if reconstructed is not None
+        else vn.to_signal(z, state.codec)
+    )
+
+    imputed = vn.generate(
+        codec=state.codec,
+        time_steps=z.shape[-1],
+        start_tokens=z,
+        mask=mask,
+        compile_forward=True,
+    )
 
     for i in range(len(val_idx)):
         imputed_noisy[i].cpu().write_audio_to_tb(
@@ -431,28 +607,25 @@ def save_imputation(state, z, val_idx, writer):
 def save_samples(state: State, val_idx: int, writer: SummaryWriter):
     state.model.eval()
     state.codec.eval()
-    vn = accel.unwrap(state.model)
+    vn = unwrap(state.model)
 
-    batch = [state.val_data[i] for i in val_idx]
+    # load (and decode) the val files in threads so we don't block on each one in turn
+    batch = parallelize(
+        state.val_data.__getitem__, val_idx, max_workers=len(val_idx), disable=True
+    )
     batch = at.util.prepare_batch(state.val_data.collate(batch), accel.device)
 
     signal = apply_transform(state.val_data.transform, batch)
 
-    z = state.codec.encode(signal.samples, signal.sample_rate)["codes"]
-    z = z[:, : vn.n_codebooks, :]
+    z = encode(state.codec, signal, vn.n_codebooks)
 
     r = torch.linspace(0.1, 0.95, len(val_idx)).to(accel.device)
 
-
-    mask = pmask.random(z, r)
-    mask = pmask.codebook_unmask(mask, vn.n_conditioning_codebooks)
-    z_mask, mask = pmask.apply_mask(z, mask, vn.mask_token)
-
-    z_mask_latent = vn.embedding.from_codes(z_mask, state.codec)
+    z_mask, mask, z_mask_latent = mask_and_embed(z, r, vn, state.codec)
 
     z_hat = state.model(z_mask_latent)
 
-    z_pred = torch.softmax(z_hat, dim=1).argmax(dim=1)
+    z_pred = z_hat.argmax(dim=1)
     z_pred = codebook_unflatten(z_pred, n_c=vn.n_predict_codebooks)
     z_pred = torch.cat([z[:, : vn.n_conditioning_codebooks, :], z_pred], dim=1)
 
@@ -476,7 +649,10 @@ def save_samples(state: State, val_idx: int, writer: SummaryWriter):
             )
 
     save_sampled(state=state, z=z, writer=writer)
-    save_imputation(state=state, z=z, val_idx=val_idx, writer=writer)
+    save_imputation(
+        state=state, z=z, val_idx=val_idx, writer=writer,
+        reconstructed=reconstructed
+    )
 
 
 
@@ -490,9 +666,14 @@ def load(
     tag: str = "latest",
     fine_tune_checkpoint: Optional[str] = None,
     grad_clip_val: float = 5.0,
+    grad_acc_steps: int = 1,
 ) -> State:
     codec = DAC.load(args["codec_ckpt"], map_location="cpu")
+    # the codec is frozen, so move it to the device once and keep it there
+    codec.to(accel.device)
     codec.eval()
+    for p in codec.parameters():
+        p.requires_grad_(False)
 
     model, v_extra = None, {}
 
@@ -513,23 +694,35 @@ def load(
 
     if args["fine_tune"]:
         assert fine_tune_checkpoint is not None, "Must provide a fine-tune checkpoint"
-        model = torch.compile(
-            VampNet.load(location=Path(fine_tune_checkpoint), 
-                         map_location="cpu", 
-            )
+        model = VampNet.load(
+            location=Path(fine_tune_checkpoint), map_location="cpu",
         )
 
 
-    model = torch.compile(VampNet()) if model is None else model
+    model = VampNet() if model is None else model
     model = accel.prepare_model(model)
+    # shapes are fixed during training, so specialize + autotune the kernels for them
+    model = torch.compile(model, mode="max-autotune", fullgraph=False, dynamic=False)
 
-    # assert accel.unwrap(model).n_codebooks == codec.quantizer.n_codebooks
+    # assert unwrap(model).n_codebooks == codec.quantizer.n_codebooks
     assert (
-        accel.unwrap(model).vocab_size == codec.quantizer.quantizers[0].codebook_size
+        unwrap(model).vocab_size == codec.quantizer.quantizers[0].codebook_size
     )
 
-    optimizer = AdamW(model.parameters(), use_zero=accel.use_ddp)
-    scheduler = NoamScheduler(optimizer, d_model=accel.unwrap(model).embedding_dim)
+    # the fused kernel does the whole param + moment update in a single launch
+    fused = accel.device == "cuda"
+    if accel.use_ddp:
+        # shard the optimizer state across ranks,
+        # so each rank only keeps the adam moments for its shard
+        optimizer = ZeroRedundancyOptimizer(
+            model.parameters(),
+            optimizer_class=AdamW,
+            parameters_as_bucket_view=True,
+            fused=fused,
+        )
+    else:
+        optimizer = AdamW(model.parameters(), fused=fused)
+    scheduler = NoamScheduler(optimizer, d_model=unwrap(model).embedding_dim)
     scheduler.step()
 
     if "optimizer.pth" in v_extra:
@@ -543,13 +736,16 @@ def load(
     sample_rate = codec.sample_rate
 
     # a better rng for sampling from our schedule
-    rng = torch.quasirandom.SobolEngine(1, scramble=True, seed=args["seed"])  
+    rng = SobolPool(
+        torch.quasirandom.SobolEngine(1, scramble=True, seed=args["seed"]),
+        device=accel.device,
+    )
 
     # log a model summary w/ num params
     if accel.local_rank == 0:
-        add_num_params_repr_hook(accel.unwrap(model))
+        add_num_params_repr_hook(unwrap(model))
         with open(f"{save_path}/model.txt", "w") as f:
-            f.write(repr(accel.unwrap(model)))
+            f.write(repr(unwrap(model)))
 
     # load the datasets
     train_data, val_data = build_datasets(args, sample_rate)
@@ -565,6 +761,7 @@ def load(
         train_data=train_data,
         val_data=val_data,
         grad_clip_val=grad_clip_val,
+        grad_acc_steps=grad_acc_steps,
     )
 
 
@@ -590,6 +787,10 @@ def train(
     at.util.seed(seed)
     writer = None
 
+    if accel.amp and not uses_grad_scaler(accel):
+        # no loss scaling needed for bf16
+        accel.scaler = torch.cuda.amp.GradScaler(enabled=False)
+
     if accel.local_rank == 0:
         writer = SummaryWriter(log_dir=f"{save_path}/logs/")
         argbind.dump_args(args, f"{save_path}/args.yml")
@@ -606,12 +807,23 @@ def train(
         save_path=save_path)
     print("initialized state.")
 
+    # pin the batches (audio included) so the prefetcher's h2d copies are async
+    pin_memory = torch.cuda.is_available()
     train_dataloader = accel.prepare_dataloader(
         state.train_data,
         start_idx=state.tracker.step * batch_size,
         num_workers=num_workers,
         batch_size=batch_size,
-        collate_fn=state.train_data.collate,
+        collate_fn=(
+            PinSignalsCollate(state.train_data.collate)
+            if pin_memory else state.train_data.collate
+        ),
+        pin_memory=pin_memory,
+        # a ragged last batch would force a recompile + recapture of the graphs
+        drop_last=True,
+        # keep the workers (and their queues) alive between epochs
+        persistent_workers=num_workers > 0,
+        prefetch_factor=4 if num_workers > 0 else None,
     )
     val_dataloader = accel.prepare_dataloader(
         state.val_data,
@@ -644,7 +856,8 @@ def train(
 
     print("starting training loop.")
     with tracker.live:
-        for tracker.step, batch in enumerate(train_dataloader, start=tracker.step):
+        train_batches = CUDAPrefetcher(train_dataloader, accel.device)
+        for tracker.step, batch in enumerate(train_batches, start=tracker.step):
             train_loop(state, batch, accel)
 
             last_iter = (
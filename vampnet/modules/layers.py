@@ -5,7 +5,6 @@ from typing import Tuple
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from einops import rearrange
 from torch.nn.utils import weight_norm
 
 # Scripting this brings model speed up 1.4x
@@ -131,16 +130,19 @@ class CodebookEmbedding(nn.Module):
 
         self.out_proj = nn.Conv1d(n_codebooks * self.latent_dim, self.emb_dim, 1)
 
-    def from_codes(self, codes: torch.Tensor, codec):
+    def from_codes(self, codes: torch.Tensor, codec, codebook_offset: int = 0):
         """ 
         get a sequence of continuous embeddings from a sequence of discrete codes. 
         unlike it's counterpart in the original VQ-VAE, this function adds for any special tokens
         necessary for the language model, like <MASK>. 
+
+        `codebook_offset` is the index of the first codebook in `codes`,
+        for embedding a subset of the codebooks (e.g. all but the conditioning ones).
         """
         n_codebooks = codes.shape[1]
         latent = []
-        for i in range(n_codebooks):
-            c = codes[:, i, :]
+        for i in range(codebook_offset, codebook_offset + n_codebooks):
+            c = codes[:, i - codebook_offset, :]
 
             lookup_table = codec.quantizer.quantizers[i].codebook.weight
             if hasattr(self, "special"):
@@ -157,8 +159,12 @@ class CodebookEmbedding(nn.Module):
 
     def forward(self, latents: torch.Tensor):
         """
-        project a sequence of latents to a sequence of embeddings
+        project a sequence of latents (b, d, n) to a sequence of embeddings.
+        the embeddings are returned as (b, n, d), the layout the transformer expects.
         """
-        x = self.out_proj(latents)
+        # out_proj is a kernel size 1 conv, i.e. a linear layer over the latent dim
+        x = F.linear(
+            latents.transpose(1, 2), self.out_proj.weight.squeeze(-1), self.out_proj.bias
+        )
         return x
 
@@ -1,21 +1,19 @@
 import math
 import logging
+import functools
 from typing import Optional, Tuple, Union
 
-import numpy as np
 import torch
+import torch._dynamo
 import torch.nn as nn
 import torch.nn.functional as F
-from einops import rearrange
 import loralib as lora
 import audiotools as at
 
 from .activations import get_activation
 from .layers import CodebookEmbedding
 from .layers import FiLM
-from .layers import SequentialWithFiLM
-from .layers import WNConv1d
-from ..util import scalar_to_batch_tensor, codebook_flatten, codebook_unflatten
+from ..util import codebook_flatten, codebook_unflatten, cudagraph_mark_step_begin
 from ..mask import _gamma
 
 LORA_R = 8
@@ -24,9 +22,26 @@ LORA_R = 8
 #     return torch.log(t + eps)
 
 
+def compile_for_cuda(fn):
+    """
+    compile fn (w/ dynamic shapes) when it's called on cuda tensors,
+    and run it eagerly on every other device.
+    """
+    compiled_fn = torch.compile(fn, dynamic=True)
+
+    @functools.wraps(fn)
+    def wrapper(x, *args, **kwargs):
+        if x.is_cuda:
+            return compiled_fn(x, *args, **kwargs)
+        return fn(x, *args, **kwargs)
+
+    return wrapper
+
+
 def gumbel_noise_like(t):
-    noise = torch.zeros_like(t).uniform_(1e-20, 1)
-    return -torch.log(-torch.log(noise))
+    # -log(u) for u ~ uniform(0, 1) is exponential(1), so sample that directly
+    noise = torch.empty_like(t).exponential_().clamp_(min=1e-20)
+    return noise.log_().neg_()
 
 
 def gumbel_sample(t, temperature=1.0, dim=-1):
@@ -119,6 +134,13 @@ class MultiHeadRelativeAttention(nn.Module):
         if has_relative_attention_bias:
             self.relative_attention_bias = nn.Embedding(attention_num_buckets, n_head)
 
+        # the buckets only depend on the sequence lengths, so we keep the ones for
+        # the most recent (query_length, key_length, device) around and reuse them
+        # while that shape doesn't change (e.g. across the steps of generate).
+        # only one entry, so we don't hold on to a bucket matrix for every
+        # sequence length we've ever seen.
+        self._bucket_cache = (None, None)
+
     def _relative_position_bucket(self, relative_position):
         """Converts unbounded relative position into bounded set of buckets
         with half "exact" buckets (1 position = 1 bucket) and half "log-spaced"
@@ -187,23 +209,28 @@ class MultiHeadRelativeAttention(nn.Module):
         key_length : int
         Returns
         -------
-        Tensor[heads x 1 x T_q x T_kv]
+        Tensor[1 x heads x T_q x T_kv]
             Position bias to be applied on attention logits
         """
-
-        query_position = torch.arange(query_length, dtype=torch.long)[:, None]
-        key_position = torch.arange(key_length, dtype=torch.long)[None, :]
-        relative_position = key_position - query_position
-
-        # Convert relative position to buckets
-        relative_position_bucket = self._relative_position_bucket(relative_position)
-        relative_position_bucket = relative_position_bucket.to(
-            self.relative_attention_bias.weight.device
-        )
+        device = self.relative_attention_bias.weight.device
+        key = (query_length, key_length, device)
+        cached_key, relative_position_bucket = self._bucket_cache
+        if cached_key != key:
+            query_position = torch.arange(query_length, dtype=torch.long, device=device)
+            key_position = torch.arange(key_length, dtype=torch.long, device=device)
+            relative_position = key_position[None, :] - query_position[:, None]
+
+            # Convert relative position to buckets
+            relative_position_bucket = self._relative_position_bucket(relative_position)
+
+            # don't mutate the cache while dynamo is tracing us, and don't cache
+            # inference tensors: they'd break a later forward w/ autograd
+            if not (torch._dynamo.is_compiling() or torch.is_inference_mode_enabled()):
+                self._bucket_cache = (key, relative_position_bucket)
 
         # Index attention bias values
         values = self.relative_attention_bias(relative_position_bucket)
-        values = rearrange(values, "q k h -> h 1 q k")
+        values = values.permute(2, 0, 1).unsqueeze(0) # 1 h q k
 
         return values
 
@@ -218,39 +245,41 @@ class MultiHeadRelativeAttention(nn.Module):
         v : Tensor[B x T_kv x d_model]
             Value vectors corresponding to the keys
         mask : Tensor[B x T_q x T_kv], optional
-        position_bias: Tensor[head x 1 x T_q x T_kv]
+        position_bias: Tensor[1 x head x T_q x T_kv]
         Returns
         -------
         Tensor[B x T_q x d_model]
             Outputs after attending (key, value) using queries
         """
         # Compute query, key, value projections
-        q = rearrange(self.w_qs(q), "b l (head k) -> head b l k", head=self.n_head)
-        k = rearrange(self.w_ks(k), "b t (head k) -> head b t k", head=self.n_head)
-        v = rearrange(self.w_vs(v), "b t (head k) -> head b t k", head=self.n_head)
-
-        # Compute attention matrix
-        attn = torch.einsum("hblk,hbtk->hblt", [q, k]) / np.sqrt(q.shape[-1])
-
-        # Add relative position bias to attention scores
-        if position_bias is None:
-            if self.has_relative_attention_bias:
-                position_bias = self.compute_bias(q.size(-2), k.size(-2))
-            else:
-                position_bias = torch.zeros_like(attn)
-        attn += position_bias
-
-        # Apply mask to attention scores to prevent looking up invalid locations
-        if mask is not None:
-            attn = attn.masked_fill(mask[None] == 0, -1e9)
+        # b t (head k) -> b head t k
+        q = self.w_qs(q).unflatten(-1, (self.n_head, -1)).transpose(1, 2)
+        k = self.w_ks(k).unflatten(-1, (self.n_head, -1)).transpose(1, 2)
+        v = self.w_vs(v).unflatten(-1, (self.n_head, -1)).transpose(1, 2)
 
-        # Normalize attention scores and add dropout
-        attn = torch.softmax(attn, dim=3)
-        attn = self.dropout(attn)
+        # Relative position bias to add to the attention scores
+        if position_bias is None and self.has_relative_attention_bias:
+            position_bias = self.compute_bias(q.size(-2), k.size(-2))
+        attn_mask = position_bias
 
-        # Compute attended outputs (product of attention matrix and values)
-        output = torch.einsum("hblt,hbtv->hblv", [attn, v])
-        output = rearrange(output, "head b l v -> b l (head v)")
+        # Mask attention scores to prevent looking up invalid locations
+        if mask is not None:
+            mask_bias = torch.zeros(
+                mask.shape, dtype=q.dtype, device=q.device
+            ).masked_fill(mask == 0, -1e9)[:, None]
+            attn_mask = mask_bias if attn_mask is None else attn_mask + mask_bias
+
+        # the (bias) mask has to match the dtype of q under autocast
+        if attn_mask is not None:
+            attn_mask = attn_mask.to(q.dtype)
+
+        # Compute attended outputs w/ a fused attention kernel
+        # (scaled by 1/sqrt(d_head), softmax and dropout over the scores)
+        output = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=attn_mask,
+            dropout_p=self.dropout.p if self.training else 0.0,
+        )
+        output = output.transpose(1, 2).flatten(2) # b l (head v)
         output = self.fc(output)
 
         return output, position_bias
@@ -328,9 +357,9 @@ class TransformerLayer(nn.Module):
         x_mask : Tensor[B x T_q]
         src : Tensor[B x T_kv x D], optional
         src_mask : Tensor[B x T_kv x D], optional
-        position_bias : Tensor[heads x B x T_q x T_q], optional
+        position_bias : Tensor[1 x heads x T_q x T_q], optional
             Relative position bias for self attention layer
-        encoder_decoder_position_bias : Tensor[heads x B x T_q x T_kv], optional
+        encoder_decoder_position_bias : Tensor[1 x heads x T_q x T_kv], optional
             Relative position bias for cross attention layer
         Returns
         -------
@@ -410,29 +439,34 @@ class TransformerStack(nn.Module):
     def subsequent_mask(self, size):
         return torch.ones(1, size, size).tril().bool()
 
-    def forward(self, x, x_mask, cond=None, src=None, src_mask=None,
+    def forward(self, x, x_mask=None, cond=None, src=None, src_mask=None,
                 return_activations: bool = False
         ):
         """Computes a full transformer stack
         Parameters
         ----------
         x : Tensor[B x T_q x D]
-        x_mask : Tensor[B x T_q]
+        x_mask : Tensor[B x T_q], optional
+            None means every position is valid
         src : Tensor[B x T_kv x D], optional
         src_mask : Tensor[B x T_kv], optional
         Returns
         -------
         Tensor[B x T_q x D]
         """
+        # without padding, bidirectional self attention doesn't need a mask at all
+        if x_mask is None and (self.is_decoder or not self.bidirectional):
+            x_mask = torch.ones(x.shape[:2], dtype=torch.bool, device=x.device)
 
         # Convert `src_mask` to (B x T_q x T_kv) shape for cross attention masking
         if self.is_decoder:
             src_mask = x_mask.unsqueeze(-1) * src_mask.unsqueeze(-2)
 
         # Convert `x_mask` to (B x T_q x T_q) shape for self attention masking
-        x_mask = x_mask.unsqueeze(-2)
-        if not self.bidirectional:
-            x_mask = x_mask * self.subsequent_mask(x.size(1)).to(x_mask.device)
+        if x_mask is not None:
+            x_mask = x_mask.unsqueeze(-2)
+            if not self.bidirectional:
+                x_mask = x_mask * self.subsequent_mask(x.size(1)).to(x_mask.device)
 
         # Initialize position biases
         position_bias = None
@@ -515,36 +549,75 @@ class VampNet(at.ml.BaseModel):
 
         # Add final conv layer
         self.n_predict_codebooks = n_codebooks - n_conditioning_codebooks
-        self.classifier = SequentialWithFiLM(
-            WNConv1d(
-                embedding_dim,
-                vocab_size * self.n_predict_codebooks,
-                kernel_size=1,
-                padding="same",
-                # groups=self.n_predict_codebooks,
-            ),
-        )
+        self.classifier = nn.Linear(embedding_dim, vocab_size * self.n_predict_codebooks)
+        self._register_load_state_dict_pre_hook(self._fold_classifier_weight_norm)
+
+        # compiled forward for the sampling loop, built lazily by generate
+        # when asked to (see `compile_forward`).
+        # (a plain function, not a module, so it stays out of the state dict)
+        self._compiled_forward = None
+
+    def __getstate__(self):
+        # the compiled forward is a dynamo closure, which can't be pickled
+        # (e.g. by BaseModel.save w/ package=True), so leave it out
+        state = self.__dict__.copy()
+        state["_compiled_forward"] = None
+        return state
 
     def forward(self, x, return_activations: bool = False):
         x = self.embedding(x)
-        x_mask = torch.ones_like(x, dtype=torch.bool)[:, :1, :].squeeze(1)
 
-        x = rearrange(x, "b d n -> b n d")
-        out = self.transformer(x=x, x_mask=x_mask, return_activations=return_activations)
+        # we never pad, so there's no x_mask to build
+        out = self.transformer(x=x, return_activations=return_activations)
         if return_activations:
             out, activations = out
 
-        out = rearrange(out, "b n d -> b d n")
+        out = self.classifier(out)
 
-        out = self.classifier(out, None) # no cond here!
-
-        out = rearrange(out, "b (p c) t -> b p (t c)", c=self.n_predict_codebooks)
+        # b t (p c) -> b p (t c)
+        out = out.unflatten(-1, (-1, self.n_predict_codebooks)).transpose(1, 2).flatten(2)
 
         if return_activations:
             return out, activations
         else:
             return out
     
+    @staticmethod
+    def _fold_classifier_weight_norm(state_dict, prefix, *args):
+        """
+        the classifier used to be a weight normed, kernel size 1 conv.
+        fold the weight norm of older checkpoints into the linear layer's weight.
+        """
+        old = f"{prefix}classifier.layers.0."
+        if f"{old}weight_v" not in state_dict:
+            return
+
+        g = state_dict.pop(f"{old}weight_g")
+        v = state_dict.pop(f"{old}weight_v")
+        weight = g * v / v.norm(dim=(1, 2), keepdim=True)
+        state_dict[f"{prefix}classifier.weight"] = weight.squeeze(-1)
+        state_dict[f"{prefix}classifier.bias"] = state_dict.pop(f"{old}bias")
+
+    def sampling_forward(self, x, compile_forward: bool = False):
+        """
+        forward pass used by the sampling loop. if `compile_forward` is set (and we're
+        on gpu), the forward is compiled w/ cuda graphs, since generate calls it many
+        times with the same shapes.
+        each new input shape means a recompile and a new cuda graph capture,
+        so only turn this on for callers that always sample the same shapes
+        (like save_samples during training).
+        """
+        if not (compile_forward and x.is_cuda):
+            return self.forward(x)
+
+        if self._compiled_forward is None:
+            self._compiled_forward = torch.compile(
+                self.forward, mode="reduce-overhead", dynamic=False
+            )
+        # each call is a new step, so the graph can reuse its output buffers
+        cudagraph_mark_step_begin()
+        return self._compiled_forward(x)
+
     def r_embed(self, r, max_positions=10000):
         if self.r_cond_dim > 0:
             dtype = r.dtype
@@ -580,11 +653,12 @@ class VampNet(at.ml.BaseModel):
         )
 
         # find where the mask token is and replace it with silence in the audio
-        for tstep in range(z.shape[-1]):
-            if torch.any(z[:, :, tstep] == self.mask_token):
-                sample_idx_0 = tstep * codec.hop_length
-                sample_idx_1 = sample_idx_0 + codec.hop_length
-                signal.samples[:, :, sample_idx_0:sample_idx_1] = 0.0
+        has_mask = (z == self.mask_token).any(dim=1) # b, t
+        sample_mask = has_mask.repeat_interleave(codec.hop_length, dim=-1)
+        n_samples = min(sample_mask.shape[-1], signal.samples.shape[-1])
+        signal.samples[..., :n_samples].masked_fill_(
+            sample_mask[:, None, :n_samples], 0.0
+        )
 
         return signal
 
@@ -606,6 +680,7 @@ class VampNet(at.ml.BaseModel):
         return_signal=True,
         seed: int = None, 
         sample_cutoff: float = 1.0,
+        compile_forward: bool = False,
     ):
         if seed is not None:
             at.util.seed(seed)
@@ -619,8 +694,9 @@ class VampNet(at.ml.BaseModel):
         z = start_tokens
 
         if z is None:
-            z = torch.full((1, self.n_codebooks, time_steps), self.mask_token).to(
-                self.device
+            z = torch.full(
+                (1, self.n_codebooks, time_steps), self.mask_token,
+                dtype=torch.long, device=self.device
             )
 
         logging.debug(f"created z with shape {z.shape}")
@@ -630,11 +706,13 @@ class VampNet(at.ml.BaseModel):
         # resolve mask #
         #################
 
+        # the mask is kept as bool (True = masked) from here on
         if mask is None:
-            mask = torch.ones_like(z).to(self.device).int()
-            mask[:, : self.n_conditioning_codebooks, :] = 0.0
+            mask = torch.ones_like(z, dtype=torch.bool)
+            mask[:, : self.n_conditioning_codebooks, :] = False
+        mask = mask.bool()
         if mask.ndim == 2:
-            mask = mask[:, None, :].repeat(1, z.shape[1], 1)
+            mask = mask[:, None, :].expand(-1, z.shape[1], -1)
         # init_mask = mask.clone()
         
         logging.debug(f"created mask with shape {mask.shape}")
@@ -644,17 +722,41 @@ class VampNet(at.ml.BaseModel):
         # set up #
         ##########
         # apply the mask to z
-        z_masked = z.masked_fill(mask.bool(), self.mask_token)
+        z_masked = z.masked_fill(mask, self.mask_token)
         # logging.debug(f"z_masked: {z_masked}")
 
-        # how many mask tokens to begin with?
-        num_mask_tokens_at_start = (z_masked == self.mask_token).sum()
-        logging.debug(f"num mask tokens at start: {num_mask_tokens_at_start}")
+        # how many mask tokens to begin with? (per batch item)
+        num_mask_tokens_at_start = (z_masked == self.mask_token).sum(dim=(1, 2))
+        # (lazy formatting: printing a cuda tensor forces a sync)
+        logging.debug("num mask tokens at start: %s", num_mask_tokens_at_start)
 
         # how many codebooks are we inferring vs conditioning on?
         n_infer_codebooks = self.n_codebooks - self.n_conditioning_codebooks
         logging.debug(f"n infer codebooks: {n_infer_codebooks}")
 
+        # run the transformer in bf16 on gpus that support it
+        use_bf16 = z.is_cuda and torch.cuda.is_bf16_supported()
+
+        # the schedule doesn't depend on what we sample, so compute it for
+        # every step up front, on device.
+        # r: (steps,), num tokens to mask: (steps, b)
+        schedule_r = torch.arange(1, sampling_steps + 1, device=z.device) / sampling_steps
+        schedule_num_to_mask = torch.floor(
+            _gamma(schedule_r)[:, None] * num_mask_tokens_at_start[None, :]
+        ).long()
+
+        # keep the codebooks we're inferring flattened (b, t*c) throughout the
+        # sampling loop, we only need the (b, c, t) layout to look up the latents
+        z_cond = z_masked[:, :self.n_conditioning_codebooks, :]
+        z_masked = codebook_flatten(z_masked[:, self.n_conditioning_codebooks:, :])
+
+        # the conditioning codebooks only change once (after the first step),
+        # so embed them up front instead of every step
+        cond_latents = (
+            self.embedding.from_codes(z_cond, codec)
+            if self.n_conditioning_codebooks > 0 else None
+        )
+
         #################
         # begin sampling #
         #################
@@ -663,91 +765,69 @@ class VampNet(at.ml.BaseModel):
             logging.debug(f"step {i} of {sampling_steps}")
 
             # our current schedule step
-            r = scalar_to_batch_tensor(
-                (i + 1) / sampling_steps, 
-                z.shape[0]
-            ).to(z.device)
-            logging.debug(f"r: {r}")
-
-            # get latents
-            latents = self.embedding.from_codes(z_masked, codec)
-            logging.debug(f"computed latents with shape: {latents.shape}")
-
-
-            # infer from latents
-            # NOTE: this collapses the codebook dimension into the sequence dimension
-            logits = self.forward(latents) # b, prob, seq
-            logits = logits.permute(0, 2, 1)  # b, seq, prob
+            r = schedule_r[i].expand(z.shape[0])
+            logging.debug("r: %s", r)
+
+            with torch.autocast("cuda", dtype=torch.bfloat16, enabled=use_bf16):
+                # get latents
+                latents = self.embedding.from_codes(
+                    codebook_unflatten(z_masked, n_infer_codebooks), codec,
+                    codebook_offset=self.n_conditioning_codebooks,
+                )
+                if cond_latents is not None:
+                    latents = torch.cat((cond_latents, latents), dim=1)
+                logging.debug(f"computed latents with shape: {latents.shape}")
+
+                # infer from latents
+                # NOTE: this collapses the codebook dimension into the sequence dimension
+                logits = self.sampling_forward(
+                    latents, compile_forward=compile_forward
+                ) # b, prob, seq
+
+            # back to fp32 for the softmax / sampling
+            logits = logits.float().permute(0, 2, 1)  # b, seq, prob
             b = logits.shape[0]
 
             logging.debug(f"permuted logits with shape: {logits.shape}")
 
-            sampled_z, selected_probs = sample_from_logits(
+            sampled_z, selected_log_probs = sample_from_logits(
                 logits, sample=(
                    (i / sampling_steps) <= sample_cutoff
                 ), 
                 temperature=sampling_temperature,
                 typical_filtering=typical_filtering, typical_mass=typical_mass,
                 typical_min_tokens=typical_min_tokens,
-                top_k=None, top_p=top_p, return_probs=True,
+                top_k=None, top_p=top_p, return_log_probs=True,
             )
 
             logging.debug(f"sampled z with shape: {sampled_z.shape}")
 
-            # flatten z_masked and mask, so we can deal with the sampling logic
-            # we'll unflatten them at the end of the loop for the next forward pass
-            # remove conditioning codebooks, we'll add them back at the end
-            z_masked = codebook_flatten(z_masked[:, self.n_conditioning_codebooks:, :])           
-
-            mask = (z_masked == self.mask_token).int()
-            
-            # update the mask, remove conditioning codebooks from the mask
-            logging.debug(f"updated mask with shape: {mask.shape}")
-            # add z back into sampled z where the mask was false
-            sampled_z = torch.where(
-                mask.bool(), sampled_z, z_masked
-            )
-            logging.debug(f"added z back into sampled z with shape: {sampled_z.shape}")
-
-            # ignore any tokens that weren't masked
-            selected_probs = torch.where(
-                mask.bool(), selected_probs, torch.inf
+            # add z back into sampled z where the mask was false, and get
+            # the num tokens to mask, according to the schedule
+            sampled_z, selected_log_probs, num_to_mask = commit_samples(
+                z_masked, sampled_z, selected_log_probs,
+                schedule_num_to_mask[i].unsqueeze(1),
+                mask_token=self.mask_token,
+                last_step=(i == sampling_steps - 1),
             )
-
-            # get the num tokens to mask, according to the schedule
-            num_to_mask = torch.floor(_gamma(r) * num_mask_tokens_at_start).unsqueeze(1).long()
-            logging.debug(f"num to mask: {num_to_mask}")
-
-            if i != (sampling_steps - 1):
-                num_to_mask = torch.maximum(
-                    torch.tensor(1),
-                    torch.minimum(
-                        mask.sum(dim=-1, keepdim=True) - 1,
-                        num_to_mask
-                    )
-                )
-
+            logging.debug("num to mask: %s", num_to_mask)
 
             # get our new mask
             mask = mask_by_random_topk(
-                num_to_mask, selected_probs, mask_temperature * (1-r)
+                num_to_mask, selected_log_probs, mask_temperature * (1-r).unsqueeze(1)
             )  
 
             # update the mask
             z_masked = torch.where(
-                mask.bool(), self.mask_token, sampled_z
+                mask, self.mask_token, sampled_z
             )
             logging.debug(f"updated z_masked with shape: {z_masked.shape}")
 
-            z_masked = codebook_unflatten(z_masked, n_infer_codebooks)
-            mask = codebook_unflatten(mask, n_infer_codebooks)
-            logging.debug(f"unflattened z_masked with shape: {z_masked.shape}")
-
-            # add conditioning codebooks back to z_masked
-            z_masked = torch.cat(
-                (z[:, :self.n_conditioning_codebooks, :], z_masked), dim=1
-            )
-            logging.debug(f"added conditioning codebooks back to z_masked with shape: {z_masked.shape}")
+            # from here on, condition on the (unmasked) conditioning codebooks
+            if i == 0 and cond_latents is not None:
+                cond_latents = self.embedding.from_codes(
+                    z[:, :self.n_conditioning_codebooks, :], codec
+                )
 
 
         # add conditioning codebooks back to sampled_z
@@ -772,7 +852,7 @@ def sample_from_logits(
         typical_filtering: bool = False,
         typical_mass: float = 0.2,
         typical_min_tokens: int = 1,
-        return_probs: bool = False
+        return_log_probs: bool = False
     ):
     """Convenience function to sample from a categorial distribution with input as
     unnormalized logits.
@@ -792,16 +872,19 @@ def sample_from_logits(
         top_p : float, optional
             Restricts sampling to only those values with cumulative
             probability = `top_p`, by default None
+        return_log_probs : bool, optional
+            Whether to also return the log probability of each sampled token,
+            by default False
 
     Returns
     -------
     Tensor[...]
         Sampled tokens
+    Tensor[...], optional
+        Log probabilities of the sampled tokens
     """
-    shp = logits.shape[:-1]
-
     if typical_filtering:
-        typical_filter(logits, 
+        logits = typical_filter(logits, 
                         typical_mass=typical_mass, 
                         typical_min_tokens=typical_min_tokens
         )
@@ -829,90 +912,138 @@ def sample_from_logits(
 
         logits[indices_to_remove] = -float("inf")
 
-    # Perform multinomial sampling after normalizing logits
-    probs = (
-        F.softmax(logits / temperature, dim=-1)
+    # Normalize the (tempered) logits
+    log_probs = (
+        F.log_softmax(logits / temperature, dim=-1)
         if temperature > 0
-        else logits.softmax(dim=-1)
+        else logits.log_softmax(dim=-1)
     )
+    # the gumbel-max trick samples from the same categorical as multinomial,
+    # but in a single pass over the vocab, straight from the log probs
     token = (
-        probs.view(-1, probs.size(-1)).multinomial(1).squeeze(1).view(*shp)
+        gumbel_sample(log_probs, dim=-1)
         if sample
         else logits.argmax(-1)
     )
 
-    if return_probs:
-        token_probs = probs.take_along_dim(token.unsqueeze(-1), dim=-1).squeeze(-1)
-        return token, token_probs
+    if return_log_probs:
+        token_log_probs = log_probs.gather(-1, token.unsqueeze(-1)).squeeze(-1)
+        return token, token_log_probs
     else:
         return token
     
 
 
+@compile_for_cuda
+def commit_samples(
+        z_masked: torch.Tensor,
+        sampled_z: torch.Tensor,
+        selected_log_probs: torch.Tensor,
+        num_to_mask: torch.Tensor,
+        mask_token: int,
+        last_step: bool = False,
+    ):
+    """
+    the elementwise bookkeeping between sampling and re-masking in a generate step.
+    keeps the tokens that weren't masked in z_masked, ignores them when picking
+    which tokens to re-mask, and bounds the number of tokens to mask so that
+    every step (but the last) commits at least one token and re-masks at least one.
+
+    Args:
+        z_masked (torch.Tensor): current tokens, flattened (batch, seq)
+        sampled_z (torch.Tensor): sampled tokens, (batch, seq)
+        selected_log_probs (torch.Tensor): log probs of the sampled tokens, (batch, seq)
+        num_to_mask (torch.Tensor): tokens to mask according to the schedule, (batch, 1)
+        mask_token (int): the mask token
+        last_step (bool, optional): whether this is the last sampling step.
+    """
+    mask = z_masked == mask_token
+    sampled_z = torch.where(mask, sampled_z, z_masked)
+    # ignore any tokens that weren't masked
+    selected_log_probs = torch.where(mask, selected_log_probs, torch.inf)
+
+    if not last_step:
+        num_to_mask = torch.minimum(
+            mask.sum(dim=-1, keepdim=True) - 1,
+            num_to_mask
+        ).clamp(min=1)
+
+    return sampled_z, selected_log_probs, num_to_mask
+
+
+@compile_for_cuda
 def mask_by_random_topk(
         num_to_mask: int, 
-        probs: torch.Tensor, 
+        log_probs: torch.Tensor, 
         temperature: float = 1.0, 
     ):
     """
     Args:
         num_to_mask (int): number of tokens to mask
-        probs (torch.Tensor): probabilities for each sampled event, shape (batch, seq)
-        temperature (float, optional): temperature. Defaults to 1.0.
+        log_probs (torch.Tensor): log probabilities for each sampled event, shape (batch, seq)
+        temperature (float or torch.Tensor, optional): temperature, either a scalar
+            or one per batch item, shape (batch, 1). Defaults to 1.0.
     """
-    logging.debug(f"masking by random topk")
-    logging.debug(f"num to mask: {num_to_mask}")
-    logging.debug(f"probs shape: {probs.shape}")
-    logging.debug(f"temperature: {temperature}")
-    logging.debug("")
-
-    noise = gumbel_noise_like(probs)
-    confidence = torch.log(probs) + temperature * noise
-    logging.debug(f"confidence shape: {confidence.shape}")
+    noise = gumbel_noise_like(log_probs)
+    confidence = log_probs + temperature * noise
 
-    sorted_confidence, sorted_idx = confidence.sort(dim=-1)
-    logging.debug(f"sorted confidence shape: {sorted_confidence.shape}")
-    logging.debug(f"sorted idx shape: {sorted_idx.shape}")
+    # we only need the smallest (num_to_mask + 1) confidences to find
+    # the cut off, so take those instead of sorting the whole sequence
+    k = min(int(num_to_mask.max()) + 1, confidence.shape[-1])
+    smallest_confidence = confidence.topk(k, dim=-1, largest=False).values
 
     # get the cut off threshold, given the mask length
     cut_off = torch.take_along_dim(
-        sorted_confidence, num_to_mask, axis=-1
+        smallest_confidence, num_to_mask, axis=-1
     )
-    logging.debug(f"cut off shape: {cut_off.shape}")
 
     # mask out the tokens
     mask = confidence < cut_off
-    logging.debug(f"mask shape: {mask.shape}")
 
     return mask
 
+@compile_for_cuda
 def typical_filter(
         logits, 
         typical_mass: float = 0.95,
-        typical_min_tokens: int = 1,):
-    nb, nt, _ = logits.shape
-    x_flat = rearrange(logits, "b t l -> (b t ) l")
+        typical_min_tokens: int = 1,
+        max_typical_tokens: int = 256,):
+    """
+    only keep the most typical tokens (closest to the entropy) that together
+    make up `typical_mass` of the probability mass.
+    since the typical set is usually small, we look for its boundary among the
+    `max_typical_tokens` most typical tokens first, and only sort the full vocab
+    if some row needs more than that.
+    """
+    nb, nt, nv = logits.shape
+    x_flat = logits.reshape(nb * nt, -1)
     x_flat_norm = torch.nn.functional.log_softmax(x_flat, dim=-1)
     x_flat_norm_p = torch.exp(x_flat_norm)
     entropy = -(x_flat_norm * x_flat_norm_p).nansum(-1, keepdim=True)
 
     c_flat_shifted = torch.abs((-x_flat_norm) - entropy)
-    c_flat_sorted, x_flat_indices = torch.sort(c_flat_shifted, descending=False)
-    x_flat_cumsum = (
-        x_flat.gather(-1, x_flat_indices).softmax(dim=-1).cumsum(dim=-1)
-    )
 
+    k = min(nv, max(max_typical_tokens, typical_min_tokens))
+    c_flat_sorted, x_flat_indices = c_flat_shifted.topk(k, dim=-1, largest=False)
+    x_flat_cumsum = x_flat_norm_p.gather(-1, x_flat_indices).cumsum(dim=-1)
     last_ind = (x_flat_cumsum < typical_mass).sum(dim=-1)
-    sorted_indices_to_remove = c_flat_sorted > c_flat_sorted.gather(
-        1, last_ind.view(-1, 1)
-    )
+
+    if k < nv and bool((last_ind == k).any()):
+        k = nv
+        c_flat_sorted, x_flat_indices = torch.sort(c_flat_shifted, descending=False)
+        x_flat_cumsum = x_flat_norm_p.gather(-1, x_flat_indices).cumsum(dim=-1)
+        last_ind = (x_flat_cumsum < typical_mass).sum(dim=-1)
+
+    # remove every token less typical than the one at the boundary
+    cut_off = c_flat_sorted.gather(1, last_ind.clamp(max=k - 1).view(-1, 1))
     if typical_min_tokens > 1:
-        sorted_indices_to_remove[..., :typical_min_tokens] = 0
-    indices_to_remove = sorted_indices_to_remove.scatter(
-        1, x_flat_indices, sorted_indices_to_remove
-    )
+        cut_off = torch.maximum(
+            cut_off, c_flat_sorted[:, typical_min_tokens - 1 : typical_min_tokens]
+        )
+    indices_to_remove = c_flat_shifted > cut_off
+
     x_flat = x_flat.masked_fill(indices_to_remove, -float("Inf"))
-    logits = rearrange(x_flat, "(b t) l -> b t l", t=nt)
+    logits = x_flat.view(nb, nt, -1)
     return logits
 
 
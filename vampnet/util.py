@@ -1,7 +1,6 @@
 import tqdm
 
 import torch
-from einops import rearrange
 
 def scalar_to_batch_tensor(x, batch_size):
     return torch.tensor(x).repeat(batch_size)
@@ -32,15 +31,28 @@ def parallelize(
     else:
         raise ValueError(f"parallel must be one of 'thread_map', 'process_map', 'single', but got {parallel}")
     
+def cudagraph_mark_step_begin():
+    """
+    tell torch.compile'd cuda graphs that a new step (iteration) is starting,
+    so they can reuse their output buffers. no-op on torch versions (< 2.1)
+    that don't have it.
+    """
+    mark_step_begin = getattr(
+        getattr(torch, "compiler", None), "cudagraph_mark_step_begin", None
+    )
+    if mark_step_begin is not None:
+        mark_step_begin()
+
+
 def codebook_flatten(tokens: torch.Tensor):
     """ 
     flatten a sequence of tokens from (batch, codebook, time) to (batch, codebook * time)
     """
-    return rearrange(tokens, "b c t -> b (t c)")
+    return tokens.transpose(1, 2).reshape(tokens.shape[0], -1)
 
 def codebook_unflatten(flat_tokens: torch.Tensor, n_c: int = None):
     """
     unflatten a sequence of tokens from (batch, codebook * time) to (batch, codebook, time)
     """
-    tokens = rearrange(flat_tokens, "b (t c) -> b c t", c=n_c)
+    tokens = flat_tokens.reshape(flat_tokens.shape[0], -1, n_c).transpose(1, 2)
     return tokens